@@ -7,29 +7,48 @@ from flask import (
     jsonify,
     session
 )
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.utils import secure_filename
-from PIL import Image
-import io
 from dotenv import load_dotenv
 import os
+from pathlib import Path
 import google.generativeai as genai
-import pandas as pd
-import glob
+# pandas, numpy and ElementTree are imported in the functions that load metadata,
+# which run on the data initialization thread, so importing the app doesn't wait on them
 import json
 import time
 import traceback
 import re
 # Removed heavy NLP dependencies for better performance
-from xml.etree import ElementTree
 import utils
 from sanitize import sanitize_text
 import uuid
 import pickle
+import logging
+import orjson
+import tempfile
+import threading
+from collections import deque
+from cachetools import LRUCache
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Log to stderr (collected by gunicorn/Docker); set LOG_LEVEL=DEBUG for request dumps
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+logger = logging.getLogger(__name__)
+
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "csv", "xml", "xpt", "sas7bdat"}
+# Single precompiled suffix check used by allowed_file on every upload
+_ALLOWED_RE = re.compile(
+    r'\.(?:' + '|'.join(sorted(ALLOWED_EXTENSIONS)) + r')$', re.IGNORECASE
+)
 UPLOAD_FOLDER = "uploads"
 
 # Create upload folder if it doesn't exist
@@ -352,7 +371,155 @@ if code_example:
 
 # Initialize cached domain lookups for performance
 domain_view_cache = {}
-domain_processed = set()
+domain_processed = False
+
+# Number of user/model exchanges replayed to the LLM on each call. Older turns
+# stay in the visible chat history but are no longer re-sent as prompt tokens.
+MAX_HISTORY_TURNS = 6
+
+# Number of exchanges kept in each session's visible chat history. The oldest
+# drop off so long-lived sessions don't grow (and re-render) without bound.
+MAX_CHAT_HISTORY = 200
+
+# Direct mappings from CDISC domains to EDC view name patterns
+DOMAIN_TO_VIEW_PATTERNS = {
+    # Core SDTM domains with explicit mapping to view patterns
+    'DM': ['DM', 'DEMO', 'SUBJECT'],
+    'AE': ['AE', 'ADVERSE'],
+    'LB': ['LAB', 'BLOOD', 'SPECIMEN', 'URINE'],
+    'EX': ['EX', 'EXPOSURE', 'DRUG', 'MEDICATION', 'TREATMENT'],
+    'CM': ['CM', 'CONMED', 'MEDICATION'],
+    'MH': ['MH', 'HISTORY', 'MEDICAL'],
+    'VS': ['VS', 'VITAL', 'BP'],
+    'TU': ['TU', 'TUMOR', 'LESION'],
+    'RS': ['RS', 'RESPONSE', 'RECIST', 'EFFICACY'],
+    'EG': ['EG', 'ECG', 'ELECTRO'],
+
+    # ADaM domains
+    'ADSL': ['ADSL', 'SUBJECT', 'DEMO'],
+    'ADAE': ['ADAE', 'AE'],
+    'ADLB': ['ADLB', 'LAB'],
+    'ADEX': ['ADEX', 'EX', 'EXPOSURE'],
+    'ADCM': ['ADCM', 'CM', 'MEDICATION'],
+    'ADRS': ['ADRS', 'RESPONSE'],
+    'ADTU': ['ADTU', 'TUMOR'],
+    'ADVS': ['ADVS', 'VS', 'VITAL'],
+}
+
+# Explicit mappings to the known views of the bundled EDC export
+DOMAIN_VIEW_PRIORITY = {
+    'DM': 'V_MEDIFLEX_DM',
+    'AE': 'V_MEDIFLEX_AE',
+    'LB': 'V_MEDIFLEX_Lab',
+    'VS': 'V_MEDIFLEX_VS',
+    'EX': 'V_MEDIFLEX_EX',
+    'CM': 'V_MEDIFLEX_CM',
+    'MH': 'V_MEDIFLEX_MH',
+    'TU': 'V_MEDIFLEX_TUMOR'
+}
+
+# Standard EDC metadata columns and the source columns they can be taken from,
+# covering the naming used by different EDC systems
+EDC_COLUMN_MAPPING = {
+    'fieldname': ['fieldname', 'field', 'name', 'varname'],
+    'label': ['label', 'description', 'varlabel'],
+    'type': ['type', 'datatype', 'vartype'],
+    'length': ['length', 'size', 'varlength'],
+    'format': ['format', 'varformat'],
+    'codelist': ['codelist', 'coded_values', 'terminology']
+}
+
+# The only EDC CSV columns the assistant reads, besides the <fieldname>_STD coded-value
+# columns that build_view_records hints at; everything else is skipped at parse time
+EDC_CSV_COLUMNS = frozenset(
+    ['viewname'] + [col for options in EDC_COLUMN_MAPPING.values() for col in options]
+)
+
+# Namespace prefix used for the CDISC SDTM model XML paths
+SDTM_NS = {'sdtm': 'http://www.cdisc.org/ns/mdr/sdtm/v2.1'}
+SDTM_CLASS_TAG = f"{{{SDTM_NS['sdtm']}}}class"
+# Descendant paths in Clark notation, so lookups need no prefix translation
+SDTM_PATHS = {
+    tag: f".//{{{SDTM_NS['sdtm']}}}{tag}"
+    for tag in ('name', 'classVariable', 'label', 'definition', 'role')
+}
+SDTM_WORD_RE = re.compile(r'[a-z0-9]+')
+
+# EDC field name pattern used for the CDISC mapping hints: either the whole name looks
+# like an SDTM variable, or it contains a common SDTM variable component
+SDTM_HINT_RE = re.compile(
+    r'^(?P<name>[A-Z]{2,4})$|(?P<component>DTC|STDT|ENDT|TERM|TESTCD|ORRES|STRESC)'
+)
+
+# Standard CDISC domain patterns for identifying domains in user queries
+QUERY_DOMAIN_PATTERNS = {
+    # Core domains
+    'DM': ['demographic', 'subject', 'patient', 'dm', 'subject characteristic'],
+    'AE': ['adverse event', 'ae', 'safety', 'adverse', 'side effect', 'reaction'],
+    'LB': ['lab', 'laboratory', 'lb', 'test', 'result', 'specimen'],
+    'EX': ['exposure', 'administration', 'dose', 'ex', 'drug', 'medication taken', 'treatment'],
+    'CM': ['concomitant', 'medication', 'treatment', 'drug', 'cm', 'conmed'],
+    'MH': ['medical history', 'mh', 'prior condition', 'previous condition'],
+    'DH': ['disease history', 'dh', 'diagnosis', 'cancer history'],
+    'RS': ['response', 'recist', 'rs', 'assessment', 'evaluation'],
+    'TU': ['tumor', 'lesion', 'cancer', 'tu', 'mass', 'nodule'],
+    'VS': ['vital', 'signs', 'vs', 'blood pressure', 'temperature', 'pulse'],
+
+    # ADaM domains
+    'ADSL': ['subject level', 'adsl', 'baseline', 'population', 'disposition'],
+    'ADAE': ['adverse event analysis', 'adae', 'safety analysis'],
+    'ADLB': ['laboratory analysis', 'adlb', 'lab test analysis'],
+    'ADEX': ['exposure analysis', 'adex', 'dosing analysis', 'treatment analysis'],
+    'ADCM': ['concomitant medication analysis', 'adcm'],
+    'ADMH': ['medical history analysis', 'admh'],
+    'ADRS': ['response analysis', 'adrs', 'efficacy analysis'],
+    'ADTU': ['tumor analysis', 'adtu', 'lesion analysis'],
+    'ADVS': ['vital signs analysis', 'advs'],
+    'ADTTE': ['time to event', 'adtte', 'survival', 'duration', 'ttx', 'tte'],
+    'ADTR': ['tumor response', 'adtr', 'best response', 'bor', 'overall response'],
+}
+
+# (domain, lowercased domain, keyword set) per domain, for scoring lowercased queries
+QUERY_DOMAINS = [
+    (domain, domain.lower(), frozenset(pattern.lower() for pattern in patterns))
+    for domain, patterns in QUERY_DOMAIN_PATTERNS.items()
+]
+QUERY_KEYWORDS = frozenset().union(*(keywords for _, _, keywords in QUERY_DOMAINS))
+
+# One scan finds the longest keyword starting at each position of the query (the
+# lookahead lets matches overlap). Every keyword occurring in the query is a
+# substring of one of those, so QUERY_KEYWORD_CLOSURE maps each keyword to all
+# keywords it contains, e.g. 'adverse event' -> {'adverse event', 'adverse', 'ae'}.
+QUERY_KEYWORD_RE = re.compile('(?=(' + '|'.join(
+    re.escape(keyword) for keyword in sorted(QUERY_KEYWORDS, key=len, reverse=True)
+) + '))')
+QUERY_KEYWORD_CLOSURE = {
+    keyword: frozenset(other for other in QUERY_KEYWORDS if other in keyword)
+    for keyword in QUERY_KEYWORDS
+}
+
+# Word-boundary matcher for every domain code that can key domain_view_cache,
+# so that e.g. 'dm' matches "DM data" but not "ADMH"
+DOMAIN_WORD_RE = {
+    domain: re.compile(r'\b' + re.escape(domain) + r'\b')
+    for domain in {d.lower() for d in [*DOMAIN_TO_VIEW_PATTERNS, *DOMAIN_VIEW_PRIORITY, *QUERY_DOMAIN_PATTERNS]}
+}
+
+# Phrases that settle analyze_query_type outright, matched anywhere in the lowercased
+# query. SQL keywords and code requests both mean 'code' and are checked first.
+QUERY_CODE_RE = re.compile('|'.join(map(re.escape, [
+    'select', 'from', 'where', 'join', 'group by', 'order by', 'having', 'union',
+    'create a', 'generate a', 'write a', 'build a', 'implement', 'code for'
+])))
+QUERY_EXPLANATION_RE = re.compile('|'.join(map(re.escape, [
+    'what is', 'how does', 'explain', 'why is', 'tell me about', 'describe'
+])))
+
+# Word sets for the indicator scoring fallback in analyze_query_type, matched against
+# the query's words so trailing punctuation ("code?", "sql,") doesn't hide them
+CODE_INDICATOR_SET = frozenset(code_indicators)
+EXPLANATION_INDICATOR_SET = frozenset(explanation_indicators)
+QUERY_WORD_RE = re.compile(r'\w+')
 
 # Create model with specific configuration for clinical data
 try:
@@ -366,9 +533,9 @@ try:
         },
         system_instruction=system_instruction
     )
-    print("Successfully created Gemini model")
+    logger.info("Successfully created Gemini model")
 except Exception as e:
-    print(f"ERROR creating model: {e}")
+    logger.error("Error creating model: %s", e)
     traceback.print_exc()
     # Fallback to a different model if the specified one isn't available
     try:
@@ -382,60 +549,122 @@ except Exception as e:
             },
             system_instruction=system_instruction
         )
-        print("Using fallback model gemini-pro")
+        logger.info("Using fallback model gemini-pro")
     except Exception as e2:
-        print(f"ERROR creating fallback model: {e2}")
+        logger.error("Error creating fallback model: %s", e2)
         traceback.print_exc()
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Serializes jsonify responses with orjson: compact, and much faster on long chat responses"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__, static_folder='static', template_folder='templates')
+app.json = OrjsonProvider(app)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'cdisc-standards-assistant-key')
 
+# Parsed metadata is cached next to its source file with this suffix
+PARSE_CACHE_SUFFIX = '.meta.pkl'
+# Bump when the pickled layout changes. Each reader also passes a schema describing
+# how it parses; a cache written under another version or schema is parsed again.
+PARSE_CACHE_VERSION = 1
+EDC_CSV_SCHEMA = ('edc-csv', tuple(sorted(EDC_CSV_COLUMNS)), '*_STD', 'viewname:category')
+SDTM_XML_SCHEMA = ('sdtm-xml', tuple(sorted(SDTM_PATHS.items())))
+
+# Maps SHA-256 of uploaded file contents to the Gemini file they were uploaded as
+UPLOAD_CACHE_PATH = os.path.join('data', '.upload_cache.json')
+
 # Session data storage
 SESSION_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'session_data')
 os.makedirs(SESSION_DATA_DIR, exist_ok=True)
 
+# Number of sessions kept in memory. The least recently used are evicted; their
+# history is saved after every message and reloaded from disk on their next request.
+MAX_SESSIONS = 1024
+
+class SessionCache(LRUCache):
+    """LRU map of session_id to chat session that drops the session's other state on eviction"""
+    def popitem(self):
+        session_id, chat_session = super().popitem()
+        chat_histories.pop(session_id, None)
+        if uploaded_files.pop(session_id, None) is not None:
+            mark_uploaded_files_changed()
+        return session_id, chat_session
+
 # These will be specific to each session
-chat_sessions = {}  # Maps session_id to chat_session object
-next_message = ""
-next_image = ""
+chat_sessions = SessionCache(maxsize=MAX_SESSIONS)  # Maps session_id to chat_session object
 uploaded_files = {}  # Maps session_id to uploaded_files list
+_files_version = 0   # Bumped on every change to uploaded_files; the /get_files ETag
+_files_etag_prefix = uuid.uuid4().hex  # Per process, so a restarted counter can't repeat an old ETag
+session_state_lock = threading.RLock()  # Held for every change to chat_sessions, chat_histories and uploaded_files
 edc_metadata = None  # Global metadata shared across sessions
+edc_view_groups = {} # Maps viewname to its rows of edc_metadata
+edc_view_records = {}  # Maps viewname to its variable records, see build_view_records
+_edc_version = 0     # Bumped whenever edc_metadata is replaced
+_viewnames_cache = ((), ())
+_viewnames_version = -1
 sdtm_metadata = {}   # Global metadata shared across sessions
-chat_histories = {}  # Maps session_id to chat_history list
+sdtm_index = {}      # First-word index over sdtm_metadata, see build_sdtm_index
+_sdtm_version = 0    # Bumped once sdtm_index is replaced
+chat_histories = {}  # Maps session_id to chat_history deque, see new_chat_history
+upload_cache = {}    # Content hash -> Gemini file, loaded by upload_data_files
+upload_cache_lock = threading.Lock()  # Uploads run concurrently, see upload_data_files
+data_files = []      # Files from data/ uploaded at startup, shown to every session
+_local_ready = threading.Event()  # Set once the data/ metadata is loaded into memory
 
 # Don't load heavy NLP models for better performance
 nlp_models_loaded = False
-print("Using lightweight keyword matching for better performance")
+logger.info("Using lightweight keyword matching for better performance")
 
 def get_or_create_session_id():
     """Get or create a unique session ID for the current user"""
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
-        print(f"Created new session: {session['session_id']}")
+        logger.info("Created new session: %s", session['session_id'])
     return session['session_id']
 
 def get_chat_session(session_id):
     """Get or create a chat session for the given session ID"""
-    if session_id not in chat_sessions:
-        # Create a new session
-        chat_sessions[session_id] = model.start_chat(history=[])
-        chat_histories[session_id] = []
-        uploaded_files[session_id] = []
-        print(f"Created new chat session for {session_id}")
-    return chat_sessions[session_id]
+    with session_state_lock:
+        if session_id not in chat_sessions and not load_session_data(session_id):
+            # Create a new session
+            chat_sessions[session_id] = model.start_chat(history=[])
+            chat_histories[session_id] = new_chat_history()
+            uploaded_files[session_id] = []
+            mark_uploaded_files_changed()
+            logger.info("Created new chat session for %s", session_id)
+        return chat_sessions[session_id]
+
+def mark_uploaded_files_changed():
+    """Invalidates the /get_files ETag; call after any change to uploaded_files"""
+    global _files_version
+    _files_version += 1
+
+def new_chat_history(messages=()):
+    """Returns a chat history holding at most the last MAX_CHAT_HISTORY messages"""
+    return deque(messages, maxlen=MAX_CHAT_HISTORY)
 
 def get_chat_history(session_id):
     """Get the chat history for the given session ID"""
-    if session_id not in chat_histories:
-        chat_histories[session_id] = []
-    return chat_histories[session_id]
+    with session_state_lock:
+        if session_id not in chat_histories:
+            chat_histories[session_id] = new_chat_history()
+        return chat_histories[session_id]
 
 def save_session_data(session_id):
     """Save session data to a file"""
     try:
-        if session_id in chat_histories:
+        with session_state_lock:
+            if session_id not in chat_histories:
+                # Evicted from memory since the request looked it up; its last save stands
+                logger.warning("Session %s is no longer in memory, not saved", session_id)
+                return False
+            
             # Save chat history
             session_file = os.path.join(SESSION_DATA_DIR, f"{session_id}_history.pkl")
             with open(session_file, 'wb') as f:
@@ -447,25 +676,27 @@ def save_session_data(session_id):
                 with open(files_file, 'wb') as f:
                     pickle.dump(uploaded_files[session_id], f)
             
-            print(f"Session data saved for {session_id}")
+            logger.info("Session data saved for %s", session_id)
             return True
     except Exception as e:
-        print(f"Error saving session data: {e}")
+        logger.error("Error saving session data: %s", e)
         traceback.print_exc()
     return False
 
 def load_session_data(session_id):
-    """Load session data from a file"""
+    """Load session data from a file; call with session_state_lock held"""
     try:
         # Load chat history
         history_file = os.path.join(SESSION_DATA_DIR, f"{session_id}_history.pkl")
         if os.path.exists(history_file):
             with open(history_file, 'rb') as f:
-                chat_histories[session_id] = pickle.load(f)
+                # Older session files hold a plain list
+                chat_histories[session_id] = new_chat_history(pickle.load(f))
             
-            # Recreate session with loaded history for the LLM
+            # Recreate session with the most recent turns for the LLM
+            history = chat_histories[session_id]
             history_for_llm = []
-            for msg in chat_histories[session_id]:
+            for msg in islice(history, max(len(history) - MAX_HISTORY_TURNS, 0), None):
                 if 'user' in msg and 'bot' in msg:
                     history_for_llm.append({
                         'role': 'user',
@@ -485,18 +716,40 @@ def load_session_data(session_id):
             if os.path.exists(files_file):
                 with open(files_file, 'rb') as f:
                     uploaded_files[session_id] = pickle.load(f)
+                mark_uploaded_files_changed()
             
-            print(f"Session data loaded for {session_id}")
+            logger.info("Session data loaded for %s", session_id)
             return True
     except Exception as e:
-        print(f"Error loading session data: {e}")
+        logger.error("Error loading session data: %s", e)
         traceback.print_exc()
         # Start with a fresh session if loading fails
-        chat_histories[session_id] = []
+        chat_histories[session_id] = new_chat_history()
         chat_sessions[session_id] = model.start_chat(history=[])
         uploaded_files[session_id] = []
+        mark_uploaded_files_changed()
     return False
 
+_now_str_cache = (0, "")
+
+def now_str():
+    """Returns the local time as 'YYYY-mm-dd HH:MM:SS', formatted at most once per second"""
+    global _now_str_cache
+    second = int(time.time())
+    if second != _now_str_cache[0]:
+        _now_str_cache = (second, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second)))
+    return _now_str_cache[1]
+
+def trim_chat_session(chat_session):
+    """Drops the oldest turns so the prompt sent to the LLM stays bounded"""
+    history = chat_session.history
+    if len(history) > MAX_HISTORY_TURNS * 2:
+        # Restored histories can hold consecutive user turns (empty replies are skipped),
+        # so start the kept slice at its first user turn rather than assume pairs
+        tail = history[-MAX_HISTORY_TURNS * 2:]
+        start = next((i for i, content in enumerate(tail) if content.role == "user"), 0)
+        chat_session.history = tail[start:]
+
 def process_markdown_to_html(markdown_text):
     """
     Simple markdown to HTML converter
@@ -600,218 +853,333 @@ def sanitize_markdown(text):
 
 def allowed_file(filename):
     """Returns if a filename is supported via its extension"""
-    _, ext = os.path.splitext(filename)
-    return ext.lstrip('.').lower() in ALLOWED_EXTENSIONS
+    return _ALLOWED_RE.search(filename) is not None
+
+def load_upload_cache():
+    """Loads the content-hash to Gemini file mapping saved by earlier runs"""
+    try:
+        with open(UPLOAD_CACHE_PATH, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning("Ignoring unreadable upload cache %s: %s", UPLOAD_CACHE_PATH, e)
+        return {}
+
+def save_upload_cache():
+    """Persists upload_cache, replacing the previous file atomically"""
+    try:
+        os.makedirs(os.path.dirname(UPLOAD_CACHE_PATH), exist_ok=True)
+        tmp_path = UPLOAD_CACHE_PATH + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(upload_cache, f)
+        os.replace(tmp_path, UPLOAD_CACHE_PATH)
+    except Exception as e:
+        logger.error("Error saving upload cache: %s", e)
+
+def is_rate_limited(error):
+    """True for HTTP 429 errors, as raised by either of the clients genai uses"""
+    status = getattr(error, 'code', None) or getattr(getattr(error, 'resp', None), 'status', None)
+    return status == 429
+
+def call_with_backoff(func, *args, retries=4, **kwargs):
+    """Calls func, retrying rate-limited calls after 1, 2, 4, ... seconds"""
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or not is_rate_limited(e):
+                raise
+            delay = 2 ** attempt
+            logger.warning("Rate limited by %s, retrying in %ss", func.__name__, delay)
+            time.sleep(delay)
 
 def upload_and_index_file(file_path, mime_type=None):
-    """Uploads a file to Gemini and returns its URI and name."""
+    """
+    Uploads a file to Gemini and returns its URI and name.
+    Files whose contents were already uploaded are reused while Gemini still has them.
+    """
     try:
-        file = genai.upload_file(file_path, mime_type=mime_type)
-        print(f"Uploaded file '{file.display_name}' as: {file.uri}")
-        return {"uri": file.uri, "name": file.name, "display_name": file.display_name}
+        digest = utils.file_sha256(file_path)
+        cached = upload_cache.get(digest)
+        if cached:
+            try:
+                file = call_with_backoff(genai.get_file, cached['name'])
+                if file.state.name == "ACTIVE":
+                    logger.info("Reusing uploaded file '%s' as: %s", file.display_name, file.uri)
+                    return cached
+            except Exception as e:
+                logger.info("Cached upload %s is no longer available: %s", cached['name'], e)
+
+        file = call_with_backoff(genai.upload_file, file_path, mime_type=mime_type)
+        logger.info("Uploaded file '%s' as: %s", file.display_name, file.uri)
+        file_data = {"uri": file.uri, "name": file.name, "display_name": file.display_name}
+        with upload_cache_lock:
+            upload_cache[digest] = file_data
+            save_upload_cache()
+        return file_data
     except Exception as e:
-        print(f"Error uploading file: {e}")
+        logger.error("Error uploading file: %s", e)
         traceback.print_exc()
         return None
 
+def wait_for_file_active(file_data):
+    """Polls one file until processing ends, backing off from 0.25s up to 2s between polls"""
+    delay = 0.25
+    file = call_with_backoff(genai.get_file, file_data['name'])
+    while file.state.name == "PROCESSING":
+        logger.debug("File %s is still processing", file.name)
+        time.sleep(delay)
+        delay = min(delay * 2, 2)
+        file = call_with_backoff(genai.get_file, file.name)
+    if file.state.name != "ACTIVE":
+        raise Exception(f"File {file.name} failed to process: State is {file.state.name}")
+
 def wait_for_files_active(files):
-    """Waits for files to be processed."""
-    print("Waiting for file processing...")
-    for file_data in files:
-        file = genai.get_file(file_data['name'])
-        while file.state.name == "PROCESSING":
-            print(".", end="", flush=True)
-            time.sleep(2)
-            file = genai.get_file(file.name)
-        if file.state.name != "ACTIVE":
-            raise Exception(f"File {file.name} failed to process: State is {file.state.name}")
-    print("All files processed successfully")
+    """Waits for files to be processed, polling them concurrently."""
+    logger.info("Waiting for file processing...")
+    with ThreadPoolExecutor(max_workers=min(8, len(files)) or 1) as executor:
+        list(executor.map(wait_for_file_active, files))
+    logger.info("All files processed successfully")
 
 def analyze_query_type(query):
     """
-    Optimized query type analysis using cached patterns for better performance.
+    Optimized query type analysis using precompiled patterns for better performance.
     """
-    # Cache for common SQL patterns - avoids multiple string checks
-    SQL_PATTERNS = ['select', 'from', 'where', 'join', 'group by', 'order by', 'having', 'union']
-    CODE_PHRASES = ['create a', 'generate a', 'write a', 'build a', 'implement', 'code for']
-    EXPLANATION_PHRASES = ['what is', 'how does', 'explain', 'why is', 'tell me about', 'describe']
-    
-    query = query.lower()
-    
-    # Fast path for obvious SQL
-    for pattern in SQL_PATTERNS:
-        if pattern in query:
-            return 'code'
-    
-    # Check for specific code phrases (faster than iterating all indicators)
-    for phrase in CODE_PHRASES:
-        if phrase in query:
-            return 'code'
-            
-    # Check for specific explanation phrases
-    for phrase in EXPLANATION_PHRASES:
-        if phrase in query:
-            return 'explanation'
+    return classify_query(query.lower().strip())
+
+@lru_cache(maxsize=512)
+def classify_query(query):
+    """Classifies a lowercased query as 'code' or 'explanation'; cached since queries repeat"""
+    # Fast path for obvious SQL and code requests, then explanation phrases
+    if QUERY_CODE_RE.search(query):
+        return 'code'
+    if QUERY_EXPLANATION_RE.search(query):
+        return 'explanation'
     
     # Only do the more expensive analysis if we haven't determined yet
-    code_score = sum(1 for word in code_indicators if word in query.split())
-    explanation_score = sum(1 for word in explanation_indicators if word in query.split())
+    words = set(QUERY_WORD_RE.findall(query))
+    code_score = len(CODE_INDICATOR_SET & words)
+    explanation_score = len(EXPLANATION_INDICATOR_SET & words)
     
     return 'code' if code_score >= explanation_score else 'explanation'
 
-def find_relevant_edc_view(query, edc_metadata):
+def optimize_edc_metadata(df):
+    """
+    Shrinks a freshly loaded EDC metadata frame: low-cardinality text columns become
+    categoricals, numbers are downcast, and rows are indexed by viewname. Rows keep
+    their CSV order, which select_edc_view relies on to break ties between views.
+    """
+    import pandas as pd
+    for col in df.columns:
+        dtype = df[col].dtype
+        if pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            if df[col].nunique(dropna=True) < 0.5 * len(df):
+                df[col] = df[col].astype('category')
+        elif pd.api.types.is_integer_dtype(dtype):
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+        elif pd.api.types.is_float_dtype(dtype):
+            df[col] = pd.to_numeric(df[col], downcast='float')
+    if 'viewname' in df.columns:
+        df = df.set_index('viewname', drop=False)
+    return df
+
+def standardize_edc_columns(df):
+    """Adds the standard EDC_COLUMN_MAPPING columns to df, copied from whichever source column exists"""
+    import numpy as np
+    for target_col, source_options in EDC_COLUMN_MAPPING.items():
+        if target_col not in df.columns:
+            for source_col in source_options:
+                if source_col in df.columns:
+                    df[target_col] = df[source_col]
+                    logger.info("Mapped '%s' to '%s'", source_col, target_col)
+                    break
+            else:
+                # If no match found, create placeholder
+                if target_col == 'fieldname':
+                    # The row's position in the CSV, as the old RangeIndex label was
+                    df[target_col] = np.arange(len(df)).astype(str)
+                elif target_col == 'label':
+                    df[target_col] = 'No description available'
+                else:
+                    df[target_col] = None
+    return df
+
+def read_edc_csv(path):
+    """
+    Reads an EDC metadata CSV, parsing only the columns listed in EDC_CSV_COLUMNS
+    and the *_STD coded-value columns.
+    The frame is kept in the parse cache, so an unchanged CSV is only parsed once;
+    EDC_CSV_SCHEMA must change with the read options below to invalidate it.
+    """
+    import pandas as pd
+    cached = load_parse_cache(path, EDC_CSV_SCHEMA)
+    if cached is not None:
+        return cached
+
+    df = pd.read_csv(
+        path,
+        usecols=lambda col: col in EDC_CSV_COLUMNS or col.endswith('_STD'),
+        dtype={'viewname': 'category'},
+        engine='c'
+    )
+    save_parse_cache(path, df, EDC_CSV_SCHEMA)
+    return df
+
+def build_view_records(df):
+    """
+    Returns {viewname: variable records} for an EDC metadata frame, each record
+    carrying a 'cdisc_hint' where the variable looks mappable to CDISC.
+    """
+    import numpy as np
+    if 'viewname' not in df.columns:
+        return {}
+    try:
+        # Identify potential CDISC mapping candidates (variables with _STD suffix or matching SDTM naming)
+        # Evaluated column-wise; the order of the conditions gives their priority
+        fieldnames = df['fieldname'].astype(str)
+        std_fields = fieldnames + '_STD'
+        matched = fieldnames.str.extract(SDTM_HINT_RE)
+        hints = np.select(
+            [
+                std_fields.isin(df.columns),                 # _STD column holds a coded value
+                matched['name'].notna(),                     # Basic pattern for SDTM var names
+                matched['component'].notna(),                # Common SDTM variable components
+            ],
+            [
+                "Coded value in " + std_fields,
+                "Potential SDTM variable",
+                "Contains SDTM component: " + matched['component'],
+            ],
+            default=None
+        )
+        
+        # Add CDISC mapping hints to records
+        records = df.to_dict('records')
+        for record, mapping_hint in zip(records, hints):
+            if mapping_hint:
+                record['cdisc_hint'] = mapping_hint
+        
+        positions = df.groupby(level='viewname', sort=False, observed=True).indices
+        return {name: [records[i] for i in rows] for name, rows in positions.items()}
+    except Exception as e:
+        logger.error("Error building EDC view records: %s", e)
+        traceback.print_exc()
+        return {}
+
+def set_edc_metadata(metadata):
+    """Replaces the shared EDC metadata and invalidates everything derived from it"""
+    global edc_metadata, edc_view_groups, edc_view_records, _edc_version, domain_view_cache, domain_processed
+    edc_metadata = standardize_edc_columns(optimize_edc_metadata(metadata))
+    if 'viewname' in edc_metadata.columns:
+        edc_view_groups = {
+            name: group
+            for name, group in edc_metadata.groupby(level='viewname', sort=False, observed=True)
+        }
+    else:
+        edc_view_groups = {}
+    edc_view_records = build_view_records(edc_metadata)
+    domain_view_cache = {}
+    domain_processed = False
+    # Bump last, so nothing is cached under the new version until all derived state is replaced
+    _edc_version += 1
+
+def get_viewnames(edc_metadata):
+    """
+    Returns (viewnames, lowercased viewnames) for the string viewnames of edc_metadata,
+    computed once per metadata version so queries don't lowercase every view again.
+    """
+    global _viewnames_cache, _viewnames_version
+    if _viewnames_version != _edc_version:
+        viewnames = tuple(v for v in edc_metadata['viewname'].unique() if isinstance(v, str))
+        _viewnames_cache = (viewnames, tuple(v.lower() for v in viewnames))
+        _viewnames_version = _edc_version
+    return _viewnames_cache
+
+def select_edc_view(query_lower, edc_metadata):
     """
     Performance-optimized function to find the most relevant EDC view based on keyword matching.
+    Expects the query already lowercased and stripped, as cached_edc_view passes it.
     Uses a cache to avoid repeated expensive matching operations.
     """
     global domain_view_cache, domain_processed
     
-    if not isinstance(edc_metadata, pd.DataFrame) or edc_metadata is None:
-        print("WARNING: edc_metadata not available")
+    if edc_metadata is None:
+        logger.warning("edc_metadata not available")
         return None
     
-    # Start timing the function
-    start_time = time.time()
-    
     # Check if we have processed views before
     if not domain_processed:
         # Cache setup - only done once per server session
         try:
-            # Extract unique viewnames just once
-            viewnames = edc_metadata['viewname'].unique()
-            string_views = [v for v in viewnames if isinstance(v, str)]
-            
-            # Pre-populate the cache with common domains
-            common_domains = ['DM', 'AE', 'LB', 'VS', 'CM', 'EX', 'TU', 'RS', 'ADSL', 'ADAE', 'ADLB']
-            
-            # Direct mappings from CDISC domains to EDC view name patterns
-            domain_to_view_patterns = {
-                # Core SDTM domains with explicit mapping to view patterns
-                'DM': ['DM', 'DEMO', 'SUBJECT'],
-                'AE': ['AE', 'ADVERSE'],
-                'LB': ['LAB', 'BLOOD', 'SPECIMEN', 'URINE'],
-                'EX': ['EX', 'EXPOSURE', 'DRUG', 'MEDICATION', 'TREATMENT'],
-                'CM': ['CM', 'CONMED', 'MEDICATION'],
-                'MH': ['MH', 'HISTORY', 'MEDICAL'],
-                'VS': ['VS', 'VITAL', 'BP'],
-                'TU': ['TU', 'TUMOR', 'LESION'],
-                'RS': ['RS', 'RESPONSE', 'RECIST', 'EFFICACY'],
-                'EG': ['EG', 'ECG', 'ELECTRO'],
-                
-                # ADaM domains
-                'ADSL': ['ADSL', 'SUBJECT', 'DEMO'],
-                'ADAE': ['ADAE', 'AE'],
-                'ADLB': ['ADLB', 'LAB'],
-                'ADEX': ['ADEX', 'EX', 'EXPOSURE'],
-                'ADCM': ['ADCM', 'CM', 'MEDICATION'],
-                'ADRS': ['ADRS', 'RESPONSE'],
-                'ADTU': ['ADTU', 'TUMOR'],
-                'ADVS': ['ADVS', 'VS', 'VITAL'],
-            }
+            string_views, views_lower = get_viewnames(edc_metadata)
             
             # Pre-populate cache with direct domain matches (most common case)
-            for domain, patterns in domain_to_view_patterns.items():
+            for domain, patterns in DOMAIN_TO_VIEW_PATTERNS.items():
                 for pattern in patterns:
-                    pattern_views = [v for v in string_views if pattern.lower() in v.lower()]
+                    pattern_lower = pattern.lower()
+                    pattern_views = [v for v, v_lower in zip(string_views, views_lower) if pattern_lower in v_lower]
                     if pattern_views:
                         # Sort by length for more specific matches
                         pattern_views.sort(key=len)
                         domain_view_cache[domain.lower()] = pattern_views[0]
-                        print(f"CACHE: Pre-populated domain {domain} with view {pattern_views[0]}")
+                        logger.debug("Pre-populated domain %s with view %s", domain, pattern_views[0])
                         break
             
-            # Also add explicit mappings for common views
-            domain_view_priority = {
-                'DM': 'V_MEDIFLEX_DM',
-                'AE': 'V_MEDIFLEX_AE',
-                'LB': 'V_MEDIFLEX_Lab',
-                'VS': 'V_MEDIFLEX_VS',
-                'EX': 'V_MEDIFLEX_EX',
-                'CM': 'V_MEDIFLEX_CM',
-                'MH': 'V_MEDIFLEX_MH',
-                'TU': 'V_MEDIFLEX_TUMOR'
-            }
-            
             # Add priority mappings to cache if they exist
-            for domain, view in domain_view_priority.items():
+            for domain, view in DOMAIN_VIEW_PRIORITY.items():
                 if view in string_views:
                     domain_view_cache[domain.lower()] = view
-                    print(f"CACHE: Added priority mapping {domain} -> {view}")
+                    logger.debug("Added priority mapping %s -> %s", domain, view)
             
             # Mark domains as processed so we don't do this again
             domain_processed = True
-            print(f"INFO: Domain view cache initialized with {len(domain_view_cache)} entries")
+            logger.info("Domain view cache initialized with %s entries", len(domain_view_cache))
             
         except Exception as e:
-            print(f"ERROR initializing domain cache: {e}")
+            logger.error("Error initializing domain cache: %s", e)
             # Continue without cache
     
     # Quick processing of query
-    query_lower = query.lower().strip()
     query_words = query_lower.split()
     
     # FAST PATH 1: Direct cache lookup for exact domain matches
     for word in query_words:
         if word in domain_view_cache:
             view = domain_view_cache[word]
-            print(f"CACHE HIT: Using cached view {view} for domain {word}")
+            logger.debug("Using cached view %s for domain %s", view, word)
             return view
     
     # FAST PATH 2: Look for domain code in query with word boundaries
     for domain in domain_view_cache.keys():
         # Check for domain with word boundaries (e.g. "DM " or " DM" but not "ADMH")
-        pattern = r'\b' + re.escape(domain) + r'\b'
-        if re.search(pattern, query_lower):
+        if DOMAIN_WORD_RE[domain].search(query_lower):
             view = domain_view_cache[domain]
-            print(f"CACHE HIT: Found domain {domain} in query with word boundary")
+            logger.debug("Found domain %s in query with word boundary", domain)
             return view
     
     # If we get here, we need to do the full analysis
     
-    # Extract unique viewnames
-    viewnames = edc_metadata['viewname'].unique()
-    string_views = [v for v in viewnames if isinstance(v, str)]
+    string_views, views_lower = get_viewnames(edc_metadata)
     
     if not string_views:
-        print("ERROR: No valid string viewnames found in metadata")
+        logger.error("No valid string viewnames found in metadata")
         return None
         
-    # Standard CDISC domain patterns for identifying domains in user queries
-    query_domain_patterns = {
-        # Core domains
-        'DM': ['demographic', 'subject', 'patient', 'dm', 'subject characteristic'],
-        'AE': ['adverse event', 'ae', 'safety', 'adverse', 'side effect', 'reaction'],
-        'LB': ['lab', 'laboratory', 'lb', 'test', 'result', 'specimen'],
-        'EX': ['exposure', 'administration', 'dose', 'ex', 'drug', 'medication taken', 'treatment'],
-        'CM': ['concomitant', 'medication', 'treatment', 'drug', 'cm', 'conmed'],
-        'MH': ['medical history', 'mh', 'prior condition', 'previous condition'],
-        'DH': ['disease history', 'dh', 'diagnosis', 'cancer history'],
-        'RS': ['response', 'recist', 'rs', 'assessment', 'evaluation'],
-        'TU': ['tumor', 'lesion', 'cancer', 'tu', 'mass', 'nodule'],
-        'VS': ['vital', 'signs', 'vs', 'blood pressure', 'temperature', 'pulse'],
-        
-        # ADaM domains
-        'ADSL': ['subject level', 'adsl', 'baseline', 'population', 'disposition'],
-        'ADAE': ['adverse event analysis', 'adae', 'safety analysis'],
-        'ADLB': ['laboratory analysis', 'adlb', 'lab test analysis'],
-        'ADEX': ['exposure analysis', 'adex', 'dosing analysis', 'treatment analysis'],
-        'ADCM': ['concomitant medication analysis', 'adcm'],
-        'ADMH': ['medical history analysis', 'admh'],
-        'ADRS': ['response analysis', 'adrs', 'efficacy analysis'],
-        'ADTU': ['tumor analysis', 'adtu', 'lesion analysis'],
-        'ADVS': ['vital signs analysis', 'advs'],
-        'ADTTE': ['time to event', 'adtte', 'survival', 'duration', 'ttx', 'tte'],
-        'ADTR': ['tumor response', 'adtr', 'best response', 'bor', 'overall response'],
-    }
-    
     # Keyword matching from query to domains - using scoring
     domain_scores = {}
     
-    for domain, patterns in query_domain_patterns.items():
-        score = sum(1 for pattern in patterns if pattern in query_lower)
+    # A single regex pass over the query yields every keyword it contains
+    query_keywords = frozenset().union(
+        *(QUERY_KEYWORD_CLOSURE[keyword] for keyword in set(QUERY_KEYWORD_RE.findall(query_lower)))
+    )
+    
+    for domain, domain_lower, domain_keywords in QUERY_DOMAINS:
+        # Count each distinct keyword once
+        score = len(domain_keywords & query_keywords)
         
         # Extra weight for domain code in query
-        if domain.lower() in query_lower:
+        if domain_lower in query_lower:
             score += 3
             
         if score > 0:
@@ -820,38 +1188,19 @@ def find_relevant_edc_view(query, edc_metadata):
     # Find best matching domain if any
     if domain_scores:
         best_domain = max(domain_scores.items(), key=lambda x: x[1])[0]
+        best_domain_lower = best_domain.lower()
         
         # Check cache for this domain
-        if best_domain.lower() in domain_view_cache:
-            view = domain_view_cache[best_domain.lower()]
-            print(f"CACHE HIT: Using cached view {view} for best domain match {best_domain}")
+        if best_domain_lower in domain_view_cache:
+            view = domain_view_cache[best_domain_lower]
+            logger.debug("Using cached view %s for best domain match %s", view, best_domain)
             return view
             
         # If not in cache, look for matching view using domain patterns
-        domain_to_view_patterns = {
-            'DM': ['DM', 'DEMO', 'SUBJECT'],
-            'AE': ['AE', 'ADVERSE'],
-            'LB': ['LAB', 'BLOOD', 'SPECIMEN', 'URINE'],
-            'EX': ['EX', 'EXPOSURE', 'DRUG', 'MEDICATION', 'TREATMENT'],
-            'CM': ['CM', 'CONMED', 'MEDICATION'],
-            'MH': ['MH', 'HISTORY', 'MEDICAL'],
-            'VS': ['VS', 'VITAL', 'BP'],
-            'TU': ['TU', 'TUMOR', 'LESION'],
-            'RS': ['RS', 'RESPONSE', 'RECIST', 'EFFICACY'],
-            'EG': ['EG', 'ECG', 'ELECTRO'],
-            'ADSL': ['ADSL', 'SUBJECT', 'DEMO'],
-            'ADAE': ['ADAE', 'AE'],
-            'ADLB': ['ADLB', 'LAB'],
-            'ADEX': ['ADEX', 'EX', 'EXPOSURE'],
-            'ADCM': ['ADCM', 'CM', 'MEDICATION'],
-            'ADRS': ['ADRS', 'RESPONSE'],
-            'ADTU': ['ADTU', 'TUMOR'],
-            'ADVS': ['ADVS', 'VS', 'VITAL'],
-        }
-        
-        view_patterns = domain_to_view_patterns.get(best_domain, [best_domain])
+        view_patterns = DOMAIN_TO_VIEW_PATTERNS.get(best_domain, [best_domain])
         for pattern in view_patterns:
-            matching_views = [v for v in string_views if pattern.lower() in v.lower()]
+            pattern_lower = pattern.lower()
+            matching_views = [v for v, v_lower in zip(string_views, views_lower) if pattern_lower in v_lower]
             if matching_views:
                 # Look for RAW vs non-RAW versions
                 non_raw_views = [v for v in matching_views if not v.upper().endswith('_RAW')]
@@ -861,217 +1210,248 @@ def find_relevant_edc_view(query, edc_metadata):
                     best_view = matching_views[0]
                 
                 # Cache this result for future use
-                domain_view_cache[best_domain.lower()] = best_view
-                print(f"SUCCESS: Domain {best_domain} matched to view {best_view} (added to cache)")
+                domain_view_cache[best_domain_lower] = best_view
+                logger.info("Domain %s matched to view %s (added to cache)", best_domain, best_view)
                 return best_view
     
-    # Fallback: direct match to known priority views
-    domain_view_priority = {
-        'DM': 'V_MEDIFLEX_DM',
-        'AE': 'V_MEDIFLEX_AE',
-        'LB': 'V_MEDIFLEX_Lab',
-        'VS': 'V_MEDIFLEX_VS',
-        'EX': 'V_MEDIFLEX_EX',
-        'CM': 'V_MEDIFLEX_CM',
-        'MH': 'V_MEDIFLEX_MH',
-        'TU': 'V_MEDIFLEX_TUMOR'
-    }
-    
     # Last resort: general-purpose fallbacks
-    fallback_views = [v for v in string_views if 'ADDCYCLE' not in v.upper()]
+    fallback_views = [v for v, v_lower in zip(string_views, views_lower) if 'addcycle' not in v_lower]
     if fallback_views:
         default_view = fallback_views[0]
-        print(f"FALLBACK: Using general view: {default_view}")
+        logger.info("Using general view: %s", default_view)
         return default_view
     
     # If no string views available at all
-    print("ERROR: No usable views found")
+    logger.error("No usable views found")
     return None
 
-def get_relevant_variables(viewname, edc_metadata):
+@lru_cache(maxsize=256)
+def cached_edc_view(query, edc_version):
+    """
+    Memoizes select_edc_view for a normalized query. edc_version is only part of the
+    key: passing _edc_version makes every metadata reload start from a cold cache.
+    """
+    return select_edc_view(query, edc_metadata)
+
+def find_relevant_edc_view(query_lower):
+    """
+    Finds the most relevant EDC view for a lowercased, stripped query and returns
+    (viewname, view_vars), where view_vars is the view's slice of the metadata.
+    Either may be None.
+    """
+    viewname = cached_edc_view(query_lower, _edc_version)
+    # Views are grouped once per metadata load, see set_edc_metadata
+    view_vars = edc_view_groups.get(viewname) if viewname else None
+    if viewname and view_vars is None:
+        logger.warning("No variables found for viewname '%s'", viewname)
+    return viewname, view_vars
+
+def get_relevant_variables(viewname):
     """
     Get relevant variables and their metadata for a specific view.
-    Contains safeguards for missing fields and data validation.
-    Enhanced to provide more context for CDISC mapping.
+    Enhanced to provide more context for CDISC mapping; the records are prebuilt
+    by build_view_records whenever the metadata is loaded.
     """
-    if not isinstance(edc_metadata, pd.DataFrame) or edc_metadata is None:
-        print("WARNING: edc_metadata is not available or not a DataFrame")
-        return []
-        
-    # Check if viewname column exists
-    if 'viewname' not in edc_metadata.columns:
-        print(f"WARNING: 'viewname' column missing from edc_metadata. Available columns: {edc_metadata.columns.tolist()}")
-        return []
-    
-    # Make sure viewname is a string
-    if not isinstance(viewname, str):
-        print(f"WARNING: viewname is not a string: {type(viewname)}")
-        return []
-    
+    records = edc_view_records.get(viewname, [])
+    logger.info("Found %s variables for viewname '%s'", len(records), viewname)
+    return records
+
+def load_parse_cache(source_path, schema):
+    """Returns the cached parse result for source_path, or None if missing, stale or parsed under another schema"""
+    cache_path = source_path + PARSE_CACHE_SUFFIX
     try:
-        # Filter the dataframe for the specific view
-        view_vars = edc_metadata[edc_metadata['viewname'] == viewname]
-        
-        # Check if we have results
-        if view_vars.empty:
-            print(f"WARNING: No variables found for viewname '{viewname}'")
-            return []
-            
-        # Handle column mapping for different EDC systems
-        column_mapping = {
-            'fieldname': ['fieldname', 'field', 'name', 'varname'],
-            'label': ['label', 'description', 'varlabel'],
-            'type': ['type', 'datatype', 'vartype'],
-            'length': ['length', 'size', 'varlength'],
-            'format': ['format', 'varformat'],
-            'codelist': ['codelist', 'coded_values', 'terminology']
-        }
-        
-        # Map columns to standardized names
-        for target_col, source_options in column_mapping.items():
-            if target_col not in view_vars.columns:
-                for source_col in source_options:
-                    if source_col in view_vars.columns:
-                        view_vars[target_col] = view_vars[source_col]
-                        print(f"INFO: Mapped '{source_col}' to '{target_col}'")
-                        break
-                else:
-                    # If no match found, create placeholder
-                    if target_col == 'fieldname':
-                        view_vars[target_col] = view_vars.index.astype(str)
-                    elif target_col == 'label':
-                        view_vars[target_col] = 'No description available'
-                    else:
-                        view_vars[target_col] = None
-        
-        # Identify potential CDISC mapping candidates (variables with _STD suffix or matching SDTM naming)
-        sdtm_pattern = re.compile(r'^[A-Z]{2,4}$')  # Basic pattern for SDTM var names
-        
-        def identify_cdisc_mapping(row):
-            # Check for _STD suffix which often indicates a coded value
-            std_field = f"{row['fieldname']}_STD" if 'fieldname' in row else None
-            if std_field and std_field in view_vars.columns.tolist():
-                return f"Coded value in {std_field}"
-            
-            # Check if the field name matches SDTM pattern
-            if sdtm_pattern.match(str(row.get('fieldname', ''))):
-                return f"Potential SDTM variable"
-            
-            # Check for common SDTM variable names in the field
-            common_sdtm_vars = ['DTC', 'STDT', 'ENDT', 'TERM', 'TESTCD', 'ORRES', 'STRESC']
-            for sdtm_var in common_sdtm_vars:
-                if sdtm_var in str(row.get('fieldname', '')):
-                    return f"Contains SDTM component: {sdtm_var}"
-            
-            return None
-        
-        # Add CDISC mapping hints to records
-        records = []
-        for _, row in view_vars.iterrows():
-            record = row.to_dict()
-            mapping_hint = identify_cdisc_mapping(record)
-            if mapping_hint:
-                record['cdisc_hint'] = mapping_hint
-            records.append(record)
-            
-        print(f"INFO: Found {len(records)} variables for viewname '{viewname}'")
-        return records
-        
+        stat = os.stat(source_path)
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if (cached['mtime'] == stat.st_mtime_ns and cached['size'] == stat.st_size
+                and cached.get('schema') == (PARSE_CACHE_VERSION, schema)):
+            return cached['data']
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        print(f"ERROR in get_relevant_variables: {e}")
-        traceback.print_exc()
-        return []
+        logger.warning("Ignoring unreadable parse cache %s: %s", cache_path, e)
+    return None
+
+def save_parse_cache(source_path, data, schema):
+    """Stores a parse result next to source_path, keyed by the source's mtime and size and the parse schema"""
+    cache_path = source_path + PARSE_CACHE_SUFFIX
+    tmp_path = None
+    try:
+        stat = os.stat(source_path)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(
+                {
+                    'mtime': stat.st_mtime_ns,
+                    'size': stat.st_size,
+                    'schema': (PARSE_CACHE_VERSION, schema),
+                    'data': data
+                },
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+        # Rename into place so readers never see a partially written cache
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.error("Error writing parse cache %s: %s", cache_path, e)
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 def parse_sdtm_xml(xml_path):
     """Parses the SDTM XML file and organizes data for access."""
+    from xml.etree import ElementTree
+    cached = load_parse_cache(xml_path, SDTM_XML_SCHEMA)
+    if cached is not None:
+        return cached
+
     try:
-        tree = ElementTree.parse(xml_path)
-        root = tree.getroot()
         sdtm_metadata = {}
 
-        for cls in root.findall('.//{http://www.cdisc.org/ns/mdr/sdtm/v2.1}class'):
-            class_name = cls.find('.//{http://www.cdisc.org/ns/mdr/sdtm/v2.1}name').text
-            sdtm_metadata[class_name] = {}
-            for var in cls.findall('.//{http://www.cdisc.org/ns/mdr/sdtm/v2.1}classVariable'):
-                var_name = var.find('.//{http://www.cdisc.org/ns/mdr/sdtm/v2.1}name').text
-                var_label = var.find('.//{http://www.cdisc.org/ns/mdr/sdtm/v2.1}label').text
-                var_def = var.find('.//{http://www.cdisc.org/ns/mdr/sdtm/v2.1}definition').text if var.find(
-                    './/{http://www.cdisc.org/ns/mdr/sdtm/v2.1}definition') is not None else ""
-                var_role = var.find('.//{http://www.cdisc.org/ns/mdr/sdtm/v2.1}role').text if var.find(
-                    './/{http://www.cdisc.org/ns/mdr/sdtm/v2.1}role') is not None else ""
-                sdtm_metadata[class_name][var_name] = {
-                    'label': var_label,
-                    'definition': var_def,
-                    'role': var_role
+        # Stream the document and drop each class subtree once it is read,
+        # so the full DOM is never held in memory
+        for _, cls in ElementTree.iterparse(xml_path, events=('end',)):
+            if cls.tag != SDTM_CLASS_TAG:
+                continue
+            class_name = cls.findtext(SDTM_PATHS['name'])
+            class_variables = sdtm_metadata[class_name] = {}
+            for var in cls.iterfind(SDTM_PATHS['classVariable']):
+                class_variables[var.findtext(SDTM_PATHS['name'])] = {
+                    'label': var.findtext(SDTM_PATHS['label']),
+                    'definition': var.findtext(SDTM_PATHS['definition'], default=""),
+                    'role': var.findtext(SDTM_PATHS['role'], default="")
                 }
+            cls.clear()
 
+        save_parse_cache(xml_path, sdtm_metadata, SDTM_XML_SCHEMA)
         return sdtm_metadata
     except Exception as e:
-        print(f"Error parsing XML file {xml_path}: {e}")
+        logger.error("Error parsing XML file %s: %s", xml_path, e)
         traceback.print_exc()
         return {}
 
-def get_sdtm_metadata(sdtm_metadata, query):
-    """Retrieves relevant SDTM metadata based on user query."""
-    relevant_metadata = ""
-
-    query = query.lower()
+def set_sdtm_metadata(metadata):
+    """Replaces the shared SDTM metadata and rebuilds its lookup index"""
+    global sdtm_metadata, sdtm_index, _sdtm_version
+    sdtm_metadata = metadata
+    sdtm_index = build_sdtm_index(metadata)
+    # Bump last: a lookup still reading the old index caches under the old version
+    _sdtm_version += 1
 
+def build_sdtm_index(sdtm_metadata):
+    """
+    Indexes every variable name, label and definition (lowercased) under its first word.
+    A text can only occur in a query if its first word does, so a query only needs to
+    check the entries filed under keys found in it.
+    Each entry carries the variable's prompt text, formatted once here.
+    """
+    sdtm_index = {}
+    order = 0
     for class_name, variables in sdtm_metadata.items():
         for var_name, metadata in variables.items():
-            if var_name.lower() in query or metadata['label'].lower() in query or metadata['definition'].lower() in query:
-                relevant_metadata += f"\n   Variable: {var_name}\n       Label: {metadata['label']}\n       Definition: {metadata['definition']}\n       Role: {metadata['role']}\n"
-    return relevant_metadata
-
-def initialize_data_files():
-    """Load initial EDC and SDTM data files"""
-    global edc_metadata, uploaded_files, sdtm_metadata
-    
-    data_directory = "data/"
-    os.makedirs(data_directory, exist_ok=True)
-    
-    edc_metadata_files = glob.glob(os.path.join(data_directory, "edc*.csv"))
-    sdtm_metadata_files = glob.glob(os.path.join(data_directory, "sdtm*.xml"))
+            formatted = f"\n   Variable: {var_name}\n       Label: {metadata['label']}\n       Definition: {metadata['definition']}\n       Role: {metadata['role']}\n"
+            for text in (var_name, metadata['label'], metadata['definition']):
+                text = (text or "").lower()
+                first_word = SDTM_WORD_RE.search(text)
+                if first_word:
+                    sdtm_index.setdefault(first_word.group(), []).append((text, order, formatted))
+            order += 1
+    return sdtm_index
+
+@lru_cache(maxsize=512)
+def lookup_sdtm_metadata(query, sdtm_version):
+    """
+    Retrieves the relevant SDTM metadata for a lowercased query, formatted from the
+    sdtm_index entries it contains. Cached because users often repeat a query;
+    sdtm_version is only part of the key: passing _sdtm_version makes every
+    metadata reload start from a cold cache.
+    """
+    # A variable matches when its name, label or definition appears anywhere in the
+    # query, including inside a longer token ("dtc" in "aestdtc")
+    matches = {}
+    for key, entries in sdtm_index.items():
+        if key in query:
+            for text, order, formatted in entries:
+                if order not in matches and text in query:
+                    matches[order] = formatted
+
+    return "".join(matches[order] for order in sorted(matches))
+
+def load_local_data_files():
+    """Loads EDC and SDTM metadata from data/ into memory and returns the files found"""
+    data_directory = Path("data")
+    data_directory.mkdir(exist_ok=True)
+    
+    # List the directory once and match both patterns against that listing
+    data_paths = sorted(data_directory.iterdir())
+    edc_metadata_files = [str(path) for path in data_paths if path.match("edc*.csv")]
+    sdtm_metadata_files = [str(path) for path in data_paths if path.match("sdtm*.xml")]
     
     if edc_metadata_files:
         try:
-            edc_metadata = pd.read_csv(edc_metadata_files[0])
-            print(f"Loaded EDC metadata from {edc_metadata_files[0]}")
+            set_edc_metadata(read_edc_csv(edc_metadata_files[0]))
+            logger.info("Loaded EDC metadata from %s", edc_metadata_files[0])
         except Exception as e:
-            print(f"Error loading EDC metadata: {e}")
+            logger.error("Error loading EDC metadata: %s", e)
             traceback.print_exc()
     
     # Load SDTM metadata from XML if available
     if sdtm_metadata_files:
         try:
-            sdtm_metadata = parse_sdtm_xml(sdtm_metadata_files[0])
-            print(f"Loaded SDTM metadata from {sdtm_metadata_files[0]}")
+            set_sdtm_metadata(parse_sdtm_xml(sdtm_metadata_files[0]))
+            logger.info("Loaded SDTM metadata from %s", sdtm_metadata_files[0])
         except Exception as e:
-            print(f"Error loading SDTM metadata: {e}")
+            logger.error("Error loading SDTM metadata: %s", e)
             traceback.print_exc()
     
-    # Upload files to Gemini
+    return edc_metadata_files, sdtm_metadata_files
+
+def upload_data_files(edc_metadata_files, sdtm_metadata_files):
+    """Uploads the data/ files to Gemini and waits until they are processed"""
+    global upload_cache
+    upload_cache = load_upload_cache()
+    
+    jobs = [(file, "text/csv", "EDC Metadata") for file in edc_metadata_files]
+    jobs += [(file, "text/xml", "SDTM Metadata") for file in sdtm_metadata_files]
+    
     files = []
     try:
-        for file in edc_metadata_files:
-            file_obj = upload_and_index_file(file, mime_type="text/csv")
-            if file_obj:
-                files.append(file_obj)
-                uploaded_files.append({"name": os.path.basename(file), "type": "EDC Metadata"})
-                
-        for file in sdtm_metadata_files:
-            file_obj = upload_and_index_file(file, mime_type="text/xml")
-            if file_obj:
-                files.append(file_obj)
-                uploaded_files.append({"name": os.path.basename(file), "type": "SDTM Metadata"})
+        # Uploads are independent network calls, so overlap them
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {executor.submit(upload_and_index_file, file, mime_type=mime_type): (file, kind)
+                       for file, mime_type, kind in jobs}
+            for future in as_completed(futures):
+                file, kind = futures[future]
+                file_obj = future.result()
+                if file_obj:
+                    files.append(file_obj)
+                    data_files.append({"name": os.path.basename(file), "type": kind})
                 
         if files:
             wait_for_files_active(files)
-            print(f"Successfully initialized {len(files)} data files")
+            logger.info("Successfully initialized %s data files", len(files))
     except Exception as e:
-        print(f"Error initializing data files: {e}")
+        logger.error("Error initializing data files: %s", e)
         traceback.print_exc()
 
+def initialize_data_files():
+    """
+    Load initial EDC and SDTM data files. Runs on a background thread: the in-memory
+    metadata is loaded first and signalled through _local_ready, then the slower
+    Gemini uploads follow.
+    """
+    try:
+        edc_metadata_files, sdtm_metadata_files = load_local_data_files()
+    finally:
+        # Never leave requests waiting on a load that failed
+        _local_ready.set()
+    
+    # The view selection tests are opt-in so that debug mode, where the reloader
+    # imports this module twice, doesn't run them on every start
+    if os.getenv('EDC_VIEW_TESTS') == '1':
+        test_edc_view_selection()
+    
+    upload_data_files(edc_metadata_files, sdtm_metadata_files)
+
 # Test function to validate the EDC view selection fix
 def test_edc_view_selection():
     """
@@ -1080,7 +1460,7 @@ def test_edc_view_selection():
     """
     global edc_metadata
     
-    if not isinstance(edc_metadata, pd.DataFrame) or edc_metadata is None:
+    if edc_metadata is None:
         print("ERROR: Cannot run tests - EDC metadata not loaded")
         return
         
@@ -1103,7 +1483,7 @@ def test_edc_view_selection():
         print(f"\nTEST QUERY: '{query}'")
         print(f"EXPECTED DOMAIN: {expected_domain}")
         
-        selected_view = find_relevant_edc_view(query, edc_metadata)
+        selected_view, view_vars = find_relevant_edc_view(query.lower().strip())
         
         if selected_view:
             # Check if view name contains expected domain (allowing for variations in casing)
@@ -1128,14 +1508,11 @@ def test_edc_view_selection():
                 print(f"❌ FAILURE: Selected view '{selected_view}' does not match expected domain '{expected_domain}'")
                 # Print the first few records for this view to understand why it was selected
                 try:
-                    view_vars = edc_metadata[edc_metadata['viewname'] == selected_view]
-                    print(f"Selected view has {len(view_vars)} variables")
-                    if not view_vars.empty:
+                    if view_vars is not None:
+                        print(f"Selected view has {len(view_vars)} variables")
                         print("First few variable names:")
-                        if 'varname' in view_vars.columns:
-                            print(view_vars['varname'].head(3).tolist())
-                        elif 'fieldname' in view_vars.columns:
-                            print(view_vars['fieldname'].head(3).tolist())
+                        # fieldname is always present after standardize_edc_columns
+                        print(view_vars['fieldname'].head(3).tolist())
                 except Exception as e:
                     print(f"Error examining view: {e}")
         else:
@@ -1143,15 +1520,9 @@ def test_edc_view_selection():
             
     print("\n===== END OF EDC VIEW SELECTION TESTS =====\n")
 
-# Initialize data files ONLY at startup (will be performed once)
-# Tests only run in development mode
-if os.getenv('FLASK_ENV') == 'development' or os.getenv('FLASK_DEBUG') == '1':
-    # Initialize files and then run tests in debug mode
-    initialize_data_files()
-    test_edc_view_selection()
-else:
-    # Just initialize files in production mode, no tests
-    initialize_data_files()
+# Initialize data files ONLY at startup (will be performed once), off the import
+# path so the worker starts serving immediately
+threading.Thread(target=initialize_data_files, name="initialize-data-files", daemon=True).start()
 
 @app.route("/upload", methods=["POST"])
 def upload_file():
@@ -1181,14 +1552,14 @@ def upload_file():
             file_type = "Image"
         elif file_ext == '.csv':
             try:
-                edc_metadata = pd.read_csv(file_path)
+                set_edc_metadata(read_edc_csv(file_path))
                 file_type = "EDC Metadata"
             except Exception as e:
                 return jsonify(success=False, message=f"Error loading CSV file: {str(e)}")
         elif file_ext == '.xml':
             try:
                 if "sdtm" in filename.lower():
-                    sdtm_metadata = parse_sdtm_xml(file_path)
+                    set_sdtm_metadata(parse_sdtm_xml(file_path))
                 file_type = "SDTM Metadata" if "sdtm" in filename.lower() else "XML Document"
             except Exception as e:
                 return jsonify(success=False, message=f"Error processing XML file: {str(e)}")
@@ -1197,12 +1568,14 @@ def upload_file():
         else:
             file_type = "Document"
             
-        # Initialize the session's uploaded files list if it doesn't exist
-        if session_id not in uploaded_files:
-            uploaded_files[session_id] = []
-            
         file_info = {"name": filename, "type": file_type}
-        uploaded_files[session_id].append(file_info)
+        # Load or create the session first so an earlier upload list is kept, then
+        # save under the lock so the session can't be evicted with the upload unsaved
+        with session_state_lock:
+            get_chat_session(session_id)
+            uploaded_files.setdefault(session_id, []).append(file_info)
+            mark_uploaded_files_changed()
+            save_session_data(session_id)
         
         return jsonify(
             success=True,
@@ -1214,8 +1587,16 @@ def upload_file():
 
 @app.route("/get_files", methods=["GET"])
 def get_files():
-    """Returns the list of uploaded files"""
-    return jsonify(success=True, assistant_files=uploaded_files)
+    """Returns the list of uploaded files, or 304 if the client's copy is current"""
+    # Read the version with the list so the tag always matches the body it is sent with
+    with session_state_lock:
+        etag = f"files-{_files_etag_prefix}-{_files_version}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify(success=True, assistant_files=uploaded_files)
+    response.set_etag(etag)
+    return response
 
 @app.route("/clear_chat", methods=["POST"])
 def clear_chat():
@@ -1227,39 +1608,39 @@ def clear_chat():
         # Get the session ID
         session_id = get_or_create_session_id()
         
-        print(f"INFO: Clearing chat history for session {session_id}")
+        logger.info("Clearing chat history for session %s", session_id)
         
         # Reset the Gemini chat session
         try:
-            chat_sessions[session_id] = model.start_chat(history=[])
-            print(f"INFO: Successfully created new Gemini chat session for {session_id}")
+            new_session = model.start_chat(history=[])
+            with session_state_lock:
+                chat_sessions[session_id] = new_session
+            logger.info("Successfully created new Gemini chat session for %s", session_id)
         except Exception as model_error:
-            print(f"ERROR: Failed to create new Gemini chat session: {model_error}")
+            logger.error("Failed to create new Gemini chat session: %s", model_error)
             traceback.print_exc()
         
         # Clear conversation state for this session
-        chat_histories[session_id] = []
+        get_chat_history(session_id).clear()
         
         # Keep uploaded_files metadata but clear session-specific data
-        if session_id in uploaded_files:
-            files_backup = uploaded_files[session_id]
-        else:
-            files_backup = []
+        with session_state_lock:
+            files_backup = uploaded_files.get(session_id, [])
         
         # Delete all session files
         try:
-            session_pattern = os.path.join(SESSION_DATA_DIR, f"{session_id}_*")
-            for session_file in glob.glob(session_pattern):
+            for session_file in Path(SESSION_DATA_DIR).glob(f"{session_id}_*"):
                 try:
                     os.remove(session_file)
-                    print(f"INFO: Removed session file: {session_file}")
+                    logger.info("Removed session file: %s", session_file)
                 except Exception as remove_error:
-                    print(f"WARNING: Failed to remove session file {session_file}: {remove_error}")
+                    logger.warning("Failed to remove session file %s: %s", session_file, remove_error)
         except Exception as file_error:
-            print(f"ERROR: Failed to clean session files: {file_error}")
+            logger.error("Failed to clean session files: %s", file_error)
         
         # Restore uploaded files metadata
-        uploaded_files[session_id] = files_backup
+        with session_state_lock:
+            uploaded_files[session_id] = files_backup
         
         # Load welcome template
         try:
@@ -1267,7 +1648,7 @@ def clear_chat():
             if os.path.exists(welcome_template_path):
                 with open(welcome_template_path, 'r') as f:
                     welcome_html = f.read()
-                    print("INFO: Successfully loaded welcome template")
+                    logger.info("Successfully loaded welcome template")
             else:
                 welcome_html = """
                 <div class="welcome-message">
@@ -1288,20 +1669,20 @@ def clear_chat():
                   <p class="prompt-tip">For best results, ask for explanations about domains before requesting code.</p>
                 </div>
                 """
-                print("INFO: Using inline welcome message (template not found)")
+                logger.info("Using inline welcome message (template not found)")
         except Exception as template_error:
-            print(f"ERROR: Failed to load welcome template: {template_error}")
+            logger.error("Failed to load welcome template: %s", template_error)
             welcome_html = "<div class='welcome-message'><h3>Chat history cleared</h3><p>You can start a new conversation.</p></div>"
         
         # Save the clean session state
         save_session_data(session_id)
         
         # Log success and return
-        print(f"INFO: Successfully cleared chat history for session {session_id}")
+        logger.info("Successfully cleared chat history for session %s", session_id)
         return jsonify(success=True, message="Chat history cleared", welcome_html=welcome_html)
     except Exception as e:
         error_message = f"Error clearing chat: {str(e)}"
-        print(f"ERROR: {error_message}")
+        logger.error(error_message)
         traceback.print_exc()
         return jsonify(success=False, message=error_message)
 
@@ -1311,16 +1692,17 @@ def index():
     session_id = get_or_create_session_id()
     
     # Try to load existing session data
-    if session_id in chat_sessions:
-        # Session already initialized
-        print(f"Using existing session: {session_id}")
-    else:
-        # Try to load from disk
-        load_result = load_session_data(session_id)
-        if load_result:
-            print(f"Loaded session data from disk for {session_id}")
+    with session_state_lock:
+        if session_id in chat_sessions:
+            # Session already initialized
+            logger.info("Using existing session: %s", session_id)
         else:
-            print(f"No saved data found for {session_id}")
+            # Try to load from disk
+            load_result = load_session_data(session_id)
+            if load_result:
+                logger.info("Loaded session data from disk for %s", session_id)
+            else:
+                logger.info("No saved data found for %s", session_id)
     
     # Ensure we have a chat session
     chat_session = get_chat_session(session_id)
@@ -1343,7 +1725,7 @@ def index():
             })
     
     # Get files for this session
-    session_files = uploaded_files.get(session_id, [])
+    session_files = data_files + uploaded_files.get(session_id, [])
     
     # Use welcome_template.html content if it exists
     welcome_html = None
@@ -1353,7 +1735,7 @@ def index():
             with open(welcome_template_path, 'r') as f:
                 welcome_html = f.read()
     except Exception as e:
-        print(f"Error loading welcome template: {e}")
+        logger.error("Error loading welcome template: %s", e)
     
     return render_template(
         "index.html", 
@@ -1369,38 +1751,36 @@ def chat():
     Contains robust error handling and logs detailed information for debugging.
     """
     try:
-        print("\n\n==== CHAT ENDPOINT CALLED ====")
-        print(f"TIME: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"METHOD: {request.method}")
-        print(f"ROUTE: {request.path}")
+        logger.info("Chat endpoint called: %s %s", request.method, request.path)
         
-        # Check for valid JSON and log the raw request data
-        print(f"DEBUG: Request headers: {dict(request.headers)}")
-        print(f"DEBUG: Request content type: {request.content_type}")
-        print(f"DEBUG: Raw request data: {request.data}")
+        # Check for valid JSON and log the raw request data. Arguments are passed
+        # lazily so the headers and body are only formatted when DEBUG is enabled.
+        logger.debug("Request headers: %s", request.headers)
+        logger.debug("Request content type: %s", request.content_type)
+        logger.debug("Raw request data: %s", request.data)
         
         if not request.is_json:
-            print(f"ERROR: Request is not JSON. Raw data: {request.data}")
+            logger.error("Request is not JSON (content type %s)", request.content_type)
             return jsonify(success=False, response="Invalid request format. Please send a JSON object with a 'message' field.")
         
         try:
             # Extract message from request
-            print(f"DEBUG: Request JSON: {request.json}")
+            logger.debug("Request JSON: %s", request.json)
             message = request.json.get("message", "").strip()
-            print(f"INFO: Received message: '{message[:50]}...' ({len(message)} chars)")
+            logger.info("Received message: '%s...' (%s chars)", message[:50], len(message))
         except Exception as e:
-            print(f"ERROR parsing JSON: {e}")
-            print(f"Raw request data: {request.data}")
+            logger.error("Error parsing JSON: %s", e)
+            logger.debug("Raw request data: %s", request.data)
             return jsonify(success=False, response="Error parsing request data. Please check your request format.")
         
         # Validate message content
         if not message:
-            print("ERROR: Empty message received")
+            logger.error("Empty message received")
             return jsonify(success=False, response="Please enter a message to continue.")
         
         # Check message length
         if len(message) > 2000:  # Set a reasonable limit
-            print(f"ERROR: Message too long ({len(message)} chars)")
+            logger.error("Message too long (%s chars)", len(message))
             return jsonify(success=False, response="Your message is too long. Please limit your query to 2000 characters.")
             
         # Get the session ID
@@ -1411,27 +1791,31 @@ def chat():
         # Add to chat history for tracking (use neutral keys that work with or without Gemini)
         chat_history.append({"user": message, "bot": ""})
         
+        # Lowercase once; the test commands, view lookup and classifiers all use it
+        message_lower = message.lower()
+        query_lower = message_lower.strip()
+        
         # For debugging/testing, provide a static response
-        if message.lower() == "test":
+        if message_lower == "test":
             test_response = "This is a test response to verify the UI is working properly."
             chat_history[-1]["bot"] = test_response
-            print("DEBUG: Returning test response")
+            logger.debug("Returning test response")
             return jsonify(success=True, response=test_response)
         
         # Add domain-specific test cases
-        if message.lower() == "test adam":
+        if message_lower == "test adam":
             test_response = "ADaM (Analysis Data Model) is a CDISC standard for representing clinical trial analysis datasets. Key ADaM datasets include ADSL (Subject Level), ADAE (Adverse Events), ADLB (Lab Tests), and ADTTE (Time-to-Event)."
             chat_history[-1]["bot"] = test_response
-            print("DEBUG: Returning ADaM test response")
+            logger.debug("Returning ADaM test response")
             return jsonify(success=True, response=test_response)
             
-        if message.lower() == "test sdtm":
+        if message_lower == "test sdtm":
             test_response = "SDTM (Study Data Tabulation Model) is a CDISC standard that organizes clinical trial data into standardized domains such as DM (Demographics), AE (Adverse Events), LB (Laboratory Tests), and VS (Vital Signs)."
             chat_history[-1]["bot"] = test_response
-            print("DEBUG: Returning SDTM test response")
+            logger.debug("Returning SDTM test response")
             return jsonify(success=True, response=test_response)
             
-        if message.lower() == "test code formatting":
+        if message_lower == "test code formatting":
             test_response = """-- This is a test of SQL code formatting with comments
 -- dbt model for DM (Demographics) dataset
 -- This model transforms source data into the CDISC SDTM DM domain
@@ -1497,7 +1881,7 @@ ORDER BY
     USUBJID  -- Ensure consistent ordering
 """
             chat_history[-1]["bot"] = test_response
-            print("DEBUG: Returning code formatting test response")
+            logger.debug("Returning code formatting test response")
             return jsonify(success=True, response=test_response)
             
         # Normal processing with the model
@@ -1506,40 +1890,45 @@ ORDER BY
             relevant_view = None
             relevant_vars = []
             
-            if isinstance(edc_metadata, pd.DataFrame) and not edc_metadata.empty:
-                relevant_view = find_relevant_edc_view(message, edc_metadata)
+            # Startup metadata loads in the background; give it a chance to finish
+            if not _local_ready.wait(timeout=30):
+                logger.warning("Data files are still loading, answering without EDC context")
+            
+            if edc_metadata is not None and not edc_metadata.empty:
+                relevant_view, view_vars = find_relevant_edc_view(query_lower)
                 if relevant_view:
-                    relevant_vars = get_relevant_variables(relevant_view, edc_metadata)
-                    print(f"INFO: Found relevant view: {relevant_view} with {len(relevant_vars)} variables")
+                    relevant_vars = get_relevant_variables(relevant_view)
+                    logger.info("Found relevant view: %s with %s variables", relevant_view, len(relevant_vars))
             
             # Start measuring prompt preparation time
             prompt_start_time = time.time()
             
             # Determine the query type using optimized analysis
-            query_type = analyze_query_type(message)
-            print(f"INFO: Query type detected as: {query_type}")
+            query_type = classify_query(query_lower)
+            logger.info("Query type detected as: %s", query_type)
             
             # Enhanced user prompt with context - more efficient implementation
             enhanced_prompt = message  # Initialize here
             if query_type == 'code' and relevant_view and relevant_vars:
                 try:
-                    # Fast implementation for variable string building - limit to 10 vars
-                    # Use list comprehension instead of loop for better performance
-                    var_strings = [
-                        f"{var.get('fieldname', 'Unknown')} ({var.get('label', 'No label')})" 
-                        for var in relevant_vars[:10] 
-                        if isinstance(var, dict) and 'fieldname' in var
-                    ]
+                    # Limit to 10 vars, formatted column-wise from the view's frame;
+                    # fieldname and label always exist after standardize_edc_columns
+                    top_vars = view_vars.head(10)
+                    var_strings = (top_vars['fieldname'].astype(str) + " (" + top_vars['label'].astype(str) + ")").tolist()
                     
                     # Fast string joining
                     relevant_vars_str = ", ".join(var_strings)
                     if len(relevant_vars) > 10:
+                        relevant_vars_str += f" and {len(relevant_vars) - 10} more"
+                    
+                    enhanced_prompt = code_prompt_template.format(
+                        query=message,
                         relevant_view=relevant_view,
                         relevant_vars=relevant_vars_str
-                    
-                    print(f"INFO: Enhanced code prompt with view context: {relevant_view}")
+                    )
+                    logger.info("Enhanced code prompt with view context: %s", relevant_view)
                 except Exception as prompt_error:
-                    print(f"ERROR building enhanced code prompt: {prompt_error}")
+                    logger.error("Error building enhanced code prompt: %s", prompt_error)
                     enhanced_prompt = message  # Fallback to original message
             elif query_type == 'explanation' and relevant_view:
                 try:
@@ -1548,58 +1937,61 @@ ORDER BY
                         query=message,
                         relevant_view=relevant_view
                     )
-                    print(f"INFO: Enhanced explanation prompt with view context: {relevant_view}")
+                    logger.info("Enhanced explanation prompt with view context: %s", relevant_view)
                 except Exception as prompt_error:
-                    print(f"ERROR building enhanced explanation prompt: {prompt_error}")
+                    logger.error("Error building enhanced explanation prompt: %s", prompt_error)
                     enhanced_prompt = message  # Fallback to original message
             else:
                 enhanced_prompt = message
-                print("INFO: Using original prompt (no enhancement)")
+                logger.info("Using original prompt (no enhancement)")
                 
             # Log prompt preparation time
             prompt_prep_time = time.time() - prompt_start_time
-            print(f"INFO: Prompt preparation took {prompt_prep_time:.3f} seconds")
+            logger.info("Prompt preparation took %.3f seconds", prompt_prep_time)
             
             # Add SDTM metadata if relevant
-            if sdtm_metadata and ('sdtm' in message.lower() or 'domain' in message.lower()):
-                relevant_sdtm_info = get_sdtm_metadata(sdtm_metadata, message)
+            if sdtm_metadata and ('sdtm' in message_lower or 'domain' in message_lower):
+                relevant_sdtm_info = lookup_sdtm_metadata(message_lower, _sdtm_version)
                 if relevant_sdtm_info:
                     enhanced_prompt += f"\n\nRelevant SDTM Metadata:\n{relevant_sdtm_info}"
-                    print("INFO: Added SDTM metadata to prompt")
+                    logger.info("Added SDTM metadata to prompt")
             
-            print(f"DEBUG: Calling model with enhanced message...")
+            logger.debug("Calling model with enhanced message...")
             # Log a preview of the prompt (not the full thing to keep logs manageable)
-            prompt_preview = enhanced_prompt[:100] + "..." if len(enhanced_prompt) > 100 else enhanced_prompt
-            print(f"DEBUG: Prompt preview: '{prompt_preview}'")
+            if logger.isEnabledFor(logging.DEBUG):
+                prompt_preview = enhanced_prompt[:100] + "..." if len(enhanced_prompt) > 100 else enhanced_prompt
+                logger.debug("Prompt preview: '%s'", prompt_preview)
             
             # Call the model with the enhanced prompt
             response = chat_session.send_message(enhanced_prompt)
             response_text = response.text
+            trim_chat_session(chat_session)
             
             # Process the response
             if not response_text or response_text.strip() == "":
                 error_msg = "No response was generated. Please try again with a different query."
-                print(f"ERROR: Empty response from model")
+                logger.error("Empty response from model")
                 chat_history[-1]["bot"] = error_msg
                 return jsonify(success=False, response=error_msg)
             
             # Store the response directly but clean out any object references
-            chat_history[-1]["bot"] = sanitize_text(response_text)
+            sanitized_response = sanitize_text(response_text)
+            chat_history[-1]["bot"] = sanitized_response
             
             # Save the updated session data
             save_session_data(session_id)
             
             # Log information about the response
-            response_preview = response_text[:100] + "..." if len(response_text) > 100 else response_text
-            print(f"INFO: Generated response: '{response_preview}'")
-            print(f"INFO: Response length: {len(response_text)} characters")
-            print(f"INFO: Contains code blocks: {'```' in response_text}")
-            print(f"INFO: Session {session_id} updated and saved")
+            if logger.isEnabledFor(logging.DEBUG):
+                response_preview = response_text[:100] + "..." if len(response_text) > 100 else response_text
+                logger.debug("Generated response: '%s'", response_preview)
+            logger.info("Response length: %s characters", len(response_text))
+            logger.info("Contains code blocks: %s", '```' in response_text)
+            logger.info("Session %s updated and saved", session_id)
             
             # Return the full text response with debug info
-            print("INFO: Returning successful response")
+            logger.info("Returning successful response")
             # Return sanitized response
-            sanitized_response = sanitize_text(response_text)
             return jsonify(
                 success=True, 
                 response=sanitized_response,
@@ -1614,7 +2006,7 @@ ORDER BY
                 
         except Exception as model_error:
             error_msg = f"Unable to generate response: {str(model_error)}"
-            print(f"ERROR: Model error: {model_error}")
+            logger.error("Model error: %s", model_error)
             traceback.print_exc()
             chat_history[-1]["bot"] = error_msg
             
@@ -1631,27 +2023,29 @@ ORDER BY
             
     except Exception as server_error:
         error_message = f"Server error occurred. Please try again later."
-        print(f"ERROR: Overall endpoint error: {server_error}")
+        logger.error("Overall endpoint error: %s", server_error)
         traceback.print_exc()
         return jsonify(success=False, response=error_message)
 
 @app.route("/stream", methods=["GET"])
 def stream():
     """
-    Alternate approach: non-streaming direct response
+    Alternate approach: streams the model's response as server-sent events
     """
-    global next_message
-    global next_image
-    global chat_history
+    # The message comes with the request rather than through shared module state
+    next_message = request.args.get('message', '').strip()
+    session_id = get_or_create_session_id()
+    chat_session = get_chat_session(session_id)
+    chat_history = get_chat_history(session_id)
     
     # Debug output
-    print(f"DEBUG: Stream request received for message: '{next_message}'")
+    logger.debug("Stream request received for message: '%s'", next_message)
     
     # Add message to history if not empty
     if next_message:
         chat_history.append({"user": next_message, "bot": ""})
     
-    # Direct approach without streaming
+    # Stream chunks as the model produces them
     def generate():
         # Send header to establish connection
         yield f"data: Connecting...\n\n"
@@ -1663,34 +2057,26 @@ def stream():
             return
             
         try:
-            # Call the model directly
-            print(f"DEBUG: Calling model with: '{next_message}'")
-            response = chat_session.send_message(next_message)
-            print(f"DEBUG: Response received, length: {len(response.text)}")
+            logger.debug("Calling model with: '%s'", next_message)
+            response = chat_session.send_message(next_message, stream=True)
             
-            # Get text
-            response_text = response.text
-            
-            # Check for code blocks
-            has_code = "```" in response_text
+            chunks = []
+            for chunk in response:
+                text = chunk.text
+                if text:
+                    chunks.append(text)
+                    # Multi-line text needs one data: field per line to survive SSE framing
+                    yield "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
             
-            if (has_code):
-                print(f"DEBUG: Response contains code blocks")
-                print(f"FULL RESPONSE WITH CODE:\n{response_text}")
-                simplified_response = "Your code example is ready. Code has been logged to the server console."
-                chat_history[-1]["bot"] = response_text
-                yield f"data: {simplified_response}\n\n"
-            else:
-                # Normal text response
-                chat_history[-1]["bot"] = response_text
-                yield f"data: {response_text}\n\n"
-                
-            # Clear message after processing
-            next_message = ""
+            response_text = "".join(chunks)
+            logger.debug("Response streamed, length: %d", len(response_text))
+            trim_chat_session(chat_session)
+            chat_history[-1]["bot"] = sanitize_text(response_text)
+            save_session_data(session_id)
             
         except Exception as e:
             error_message = f"Error generating response: {str(e)}"
-            print(f"ERROR: {error_message}")
+            logger.error(error_message)
             traceback.print_exc()
             yield f"data: {error_message}\n\n"
             if len(chat_history) > 0:
@@ -1716,68 +2102,81 @@ def get_query_type():
     query_type = analyze_query_type(query)
     return jsonify(success=True, query_type=query_type)
 
+# Headers and body size echoed back by the diagnostic endpoints
+DIAGNOSTIC_HEADERS = ('Content-Type', 'Content-Length', 'User-Agent')
+DIAGNOSTIC_BODY_LIMIT = 1024
+
+def request_body_preview():
+    """Returns the start of the request body, or just its size when it is large"""
+    length = request.content_length
+    if not length:
+        return None
+    if length > 4 * DIAGNOSTIC_BODY_LIMIT:
+        return f"<{length} bytes>"
+    return request.get_data(as_text=True)[:DIAGNOSTIC_BODY_LIMIT]
+
 @app.route("/ping", methods=["GET", "POST"])
 def ping():
     """Simple diagnostic endpoint to test connectivity"""
-    print(f"\n==== PING ENDPOINT CALLED ====")
-    print(f"TIME: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"METHOD: {request.method}")
+    logger.info("Ping endpoint called: %s", request.method)
     
     # Return request info for diagnostic purposes
     response_data = {
         "success": True,
-        "time": time.strftime('%Y-%m-%d %H:%M:%S'),
+        "time": now_str(),
         "method": request.method,
-        "headers": dict(request.headers),
+        "headers": {name: request.headers[name] for name in DIAGNOSTIC_HEADERS if name in request.headers},
         "is_json": request.is_json,
-        "data": request.get_data(as_text=True) if request.data else None
+        "data": request_body_preview()
     }
     
-    print("Ping responding with success")
+    logger.info("Ping responding with success")
     return jsonify(response_data)
 
 @app.route("/test_chat", methods=["GET", "POST"])
 def test_chat():
     """Special test endpoint that mimics the chat endpoint but without LLM processing"""
-    print(f"\n==== TEST CHAT ENDPOINT CALLED ====")
-    print(f"TIME: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"METHOD: {request.method}")
+    logger.info("Test chat endpoint called: %s", request.method)
     
     # Log all request details
-    print(f"DEBUG: Request headers: {dict(request.headers)}")
-    print(f"DEBUG: Request content type: {request.content_type}")
-    print(f"DEBUG: Request data: {request.get_data(as_text=True)}")
+    logger.debug("Request headers: %s", request.headers)
+    logger.debug("Request content type: %s", request.content_type)
+    logger.debug("Request data: %s", request_body_preview())
     
     if request.is_json:
         try:
             message = request.json.get("message", "")
-            print(f"DEBUG: Received message: '{message}'")
+            logger.debug("Received message: '%s'", message)
             
             # Return immediate success with echo
             return jsonify({
                 "success": True,
                 "response": f"Echo: {message}",
                 "metadata": {
-                    "time": time.strftime('%Y-%m-%d %H:%M:%S'),
+                    "time": now_str(),
                     "is_test": True
                 }
             })
         except Exception as e:
-            print(f"ERROR parsing JSON: {e}")
+            logger.error("Error parsing JSON: %s", e)
             return jsonify(success=False, response=f"Error parsing JSON: {str(e)}")
     else:
         # Handle non-JSON request
-        print("DEBUG: Received non-JSON request")
+        logger.debug("Received non-JSON request")
         return jsonify({
             "success": False,
             "response": "This endpoint expects a JSON request with a 'message' field",
-            "received_data": request.get_data(as_text=True)
+            "received_data": request_body_preview()
         })
 
 @app.after_request
 def add_header(response):
     """Add headers to prevent browser caching"""
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    if response.headers.get('ETag'):
+        # Let the browser keep the response but revalidate it on every use
+        response.headers['Cache-Control'] = 'no-cache'
+    else:
+        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '-1'
     return response
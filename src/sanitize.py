@@ -1,7 +1,10 @@
+# Placeholder left in text when an object was stringified on the JavaScript side
+OBJECT_PLACEHOLDER = '[object Object]'
+
 def sanitize_text(text):
     """Simple function to sanitize text with [object Object] issues"""
     if not text:
         return ""
     
     # Replace [object Object] with a more reasonable string
-    return text.replace('[object Object]', '')
+    return text.replace(OBJECT_PLACEHOLDER, '')
@@ -1,52 +1,69 @@
 import os
 import fnmatch
 import re
+import hashlib
+
+# Version ('v2-1') and type suffix patterns, compiled once for per-file calls
+FILE_VERSION_RE = re.compile(r'v(\d+-\d+)', re.IGNORECASE)
+FILE_TYPE_RE = re.compile(r'\.(csv|xml|json)$', re.IGNORECASE)
 
 def find_files(directory, pattern):
     """Lists files in a directory (and its subdirectories) that match a given pattern."""
-    matches = []
-    for root, dirnames, filenames in os.walk(directory):
-        for filename in fnmatch.filter(filenames, pattern):
-            matches.append(os.path.join(root, filename))
-    return matches
+    # Translate the pattern once; scandir entries carry their type, so no extra stat calls
+    match = re.compile(fnmatch.translate(os.path.normcase(pattern))).match
+
+    def walk(root):
+        subdirs = []
+        try:
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # Like os.walk, don't descend into symlinked directories
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif match(os.path.normcase(entry.name)):
+                        yield entry.path
+        except OSError:
+            return
+        for subdir in subdirs:
+            yield from walk(subdir)
+
+    return list(walk(directory))
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Returns the hex SHA-256 digest of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 def get_file_version(filename):
     """Extracts a version number (e.g., '2-1') from a filename using regex."""
-    match = re.search(r'v(\d+-\d+)', filename, re.IGNORECASE)
+    match = FILE_VERSION_RE.search(filename)
     if match:
         return match.group(1)
     return None
 
 def get_file_type(filename):
-  """Returns the filetype based on the suffix"""
-  match = re.search(r'.(csv|xml|json)$', filename, re.IGNORECASE)
-  if match:
+    """Returns the filetype based on the suffix"""
+    match = FILE_TYPE_RE.search(filename)
+    if match:
         return match.group(1)
-  return None
+    return None
 
 def sort_files_by_version(files):
     """Sorts files based on their version and returns the sorted list and list of XML files."""
-    # Helper function to convert version string to a tuple of integers
-    def version_to_tuple(version):
-        try:
-            parts = version.split('-')
-            return tuple(map(int, parts))
-        except:
-            return None
-
-    # Extract filename and version and put in a list
-    file_list = []
+    # Files without a version are skipped; the pattern only matches digits, so int() can't fail
+    versioned = []
     for filename in files:
-        version = get_file_version(filename)
-        if version:
-          file_list.append([filename, version_to_tuple(version)])
-    # Remove elements that didn't match the correct values
-
-    file_list = [item for item in file_list if item[1] != None]
-    #Sort
-    file_list = sorted(file_list, key=lambda x: x[1])
-    sorted_files = [item[0] for item in file_list]
+        match = FILE_VERSION_RE.search(filename)
+        if match:
+            versioned.append((tuple(map(int, match.group(1).split('-'))), filename))
+    # Sort on the version alone so files with equal versions keep their order
+    versioned.sort(key=lambda item: item[0])
+    sorted_files = [filename for _, filename in versioned]
 
     # Finally, get the last
     xml_files = [item for item in sorted_files if item.endswith(".xml")]
-    return xml_files, sorted_files
\ No newline at end of file
+    return xml_files, sorted_files